@@ -1,11 +1,81 @@
 # Barebones S3 - https://github.com/diafygi/barebones-s3 Released under MIT
+import codecs
 import io
 import os
-import datetime
+import functools
 import hashlib
 import hmac
 import http.client
+import locale
+import mmap
+import time
 import urllib.parse
+import warnings
+
+# payload hashing is much faster with OpenSSL's (hardware accelerated) SHA-256
+if hashlib.sha256.__module__ != "_hashlib":
+    warnings.warn(
+        "hashlib is not using OpenSSL for SHA-256, payload hashing will be slow"
+    )
+
+
+@functools.lru_cache(maxsize=8)
+def _derive_signing_key(aws_secret, date, aws_region):
+    """
+    Derive the AWS SigV4 signing key for S3, which only changes daily per region and secret.
+    """
+    kSecret = b"AWS4" + aws_secret.encode()
+    kDate = hmac.digest(kSecret, date.encode(), "sha256")
+    kRegion = hmac.digest(kDate, aws_region.encode(), "sha256")
+    kService = hmac.digest(kRegion, b"s3", "sha256")
+    kReqType = hmac.digest(kService, b"aws4_request", "sha256")
+    return kReqType
+
+
+# how much of a file-like payload to read at a time when hashing it
+_HASH_READ_CHUNK = 1 << 20  # 1MiB
+
+# sha256 hex digest of an empty payload
+_EMPTY_SHA256 = "e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855"
+
+
+def _mmap_body(body):
+    """
+    Memory-map a file-like body that is backed by a real file, otherwise return None.
+    """
+    try:
+        fileno = body.fileno()
+        body.seek(0, os.SEEK_END)
+        size = body.tell()
+        body.seek(0)
+        # only map when the file on disk holds the whole body (e.g. no unflushed writes)
+        if not isinstance(fileno, int) or not size or os.fstat(fileno).st_size != size:
+            return None
+        return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+
+
+# (unix second, date, datetime) of the most recent request
+_last_timestamp = (None, None, None)
+
+
+def _amz_timestamp():
+    """
+    Format the current UTC date and datetime for signing, at most once per second.
+    """
+    global _last_timestamp
+    now = int(time.time())
+    last_timestamp = _last_timestamp
+    if last_timestamp[0] != now:
+        now_gm = time.gmtime(now)
+        last_timestamp = (
+            now,
+            time.strftime("%Y%m%d", now_gm),
+            time.strftime("%Y%m%dT%H%M%SZ", now_gm),
+        )
+        _last_timestamp = last_timestamp
+    return last_timestamp[1], last_timestamp[2]
 
 
 def s3_request(
@@ -19,6 +89,9 @@ def s3_request(
     aws_key_id=None,
     aws_secret=None,
     session_token=None,
+    unsigned_payload=False,
+    conn=None,
+    query_str=None,
 ):
     """
     Make a request to the S3 API.
@@ -35,6 +108,10 @@ def s3_request(
     :param str aws_secret: The AWS Key ID's secret. Can also be callable.
     :param str session_token: If using temporary credentials, the session token to use. Can also be callable.
 
+    :param bool unsigned_payload: (Optional) Don't hash file-like bodies, so they are only read once when sent.
+    :param conn: (Optional) An http.client.HTTPSConnection to the bucket's host to reuse (keep-alive). Can also be callable.
+    :param str query_str: (Optional) Already encoded query string, sorted by key, to use instead of query.
+
     :return: The response from AWS S3 API
     :rtype: http.client.HTTPResponse
     """
@@ -44,68 +121,119 @@ def s3_request(
     aws_key_id = aws_key_id() if callable(aws_key_id) else aws_key_id
     aws_secret = aws_secret() if callable(aws_secret) else aws_secret
     session_token = session_token() if callable(session_token) else session_token
+    conn = conn() if callable(conn) else conn
     # payload size and hash
-    data_hash = hashlib.sha256(body if isinstance(body, bytes) else b"")
-    data_len = len(body) if isinstance(body, bytes) else 0
-    if hasattr(body, "read") and hasattr(body, "seek"):
-        body.seek(0)
-        while True:
-            chunk = body.read(data_hash.block_size)
-            if not chunk:
-                break
-            data_len += len(chunk)
-            data_hash.update(chunk)
+    body_map = None
+    if body is None or body == b"":
+        data_len = 0
+        payload_hash = _EMPTY_SHA256
+    elif unsigned_payload and hasattr(body, "read") and hasattr(body, "seek"):
+        body.seek(0, os.SEEK_END)
+        data_len = body.tell()
         body.seek(0)
-    payload_hash = data_hash.hexdigest()
+        payload_hash = "UNSIGNED-PAYLOAD"
+    else:
+        data_hash = hashlib.sha256(body if isinstance(body, bytes) else b"")
+        data_len = len(body) if isinstance(body, bytes) else 0
+        if hasattr(body, "read") and hasattr(body, "seek"):
+            # hash and send file-backed bodies straight from the mapped pages
+            body_map = _mmap_body(body) if hasattr(body, "fileno") else None
+            if body_map is not None:
+                data_len = len(body_map)
+                data_hash.update(body_map)
+                body = body_map
+            else:
+                body.seek(0)
+                while True:
+                    chunk = body.read(_HASH_READ_CHUNK)
+                    if not chunk:
+                        break
+                    data_len += len(chunk)
+                    data_hash.update(chunk)
+                body.seek(0)
+        payload_hash = data_hash.hexdigest()
     # reference variables
-    host = f"{bucket}.s3.{aws_region}.amazonaws.com"
-    NOW = datetime.datetime.now(tz=datetime.timezone.utc)
-    NOW_DATE = NOW.strftime("%Y%m%d")
-    NOW_DT = NOW.strftime("%Y%m%dT%H%M%SZ")
+    host = conn.host if conn is not None else f"{bucket}.s3.{aws_region}.amazonaws.com"
+    NOW_DATE, NOW_DT = _amz_timestamp()
     # canonical headers
-    cheaders = [
-        ("host", host),
-        ("x-amz-content-sha256", payload_hash),
-        ("x-amz-date", NOW_DT),
-    ]
-    cheaders += [(k.lower(), v.strip()) for k, v in (headers or {}).items()]
-    cheaders.sort(key=lambda i: i[0])
-    cheaders_str = "".join(f"{k}:{v}\n" for k, v in cheaders)
-    cheader_names = ";".join(k for k, v in cheaders)
+    cheaders = {
+        "host": host,
+        "x-amz-content-sha256": payload_hash,
+        "x-amz-date": NOW_DT,
+    }
+    if headers:
+        cheaders.update((k.lower(), v.strip()) for k, v in headers.items())
+        cheader_items = sorted(cheaders.items())
+        cheaders_str = "".join(f"{k}:{v}\n" for k, v in cheader_items)
+        cheader_names = ";".join(k for k, _ in cheader_items)
+    else:
+        # the required headers are already sorted
+        cheaders_str = (
+            f"host:{host}\nx-amz-content-sha256:{payload_hash}\nx-amz-date:{NOW_DT}\n"
+        )
+        cheader_names = "host;x-amz-content-sha256;x-amz-date"
     # signature
-    query_str = urllib.parse.urlencode(
-        sorted((query or {}).items(), key=lambda i: i[0])
+    if query_str is None:
+        query_str = (
+            urllib.parse.urlencode(sorted(query.items(), key=lambda i: i[0]))
+            if query
+            else ""
+        )
+    canonical_request = "\n".join(
+        (method, path, query_str, cheaders_str, cheader_names, payload_hash)
     )
-    canonical_request = f"{method}\n{path}\n{query_str}\n{cheaders_str}\n{cheader_names}\n{payload_hash}"
     req_hash = hashlib.sha256(canonical_request.encode()).hexdigest()
     sig_payload = f"AWS4-HMAC-SHA256\n{NOW_DT}\n{NOW_DATE}/{aws_region}/s3/aws4_request\n{req_hash}"
-    kSecret = f"AWS4{aws_secret}"
-    kDate = hmac.new(kSecret.encode(), NOW_DATE.encode(), hashlib.sha256).digest()
-    kRegion = hmac.new(kDate, aws_region.encode(), hashlib.sha256).digest()
-    kService = hmac.new(kRegion, b"s3", hashlib.sha256).digest()
-    kReqType = hmac.new(kService, b"aws4_request", hashlib.sha256).digest()
-    signature = hmac.new(kReqType, sig_payload.encode(), hashlib.sha256).hexdigest()
+    kReqType = _derive_signing_key(aws_secret, NOW_DATE, aws_region)
+    signature = hmac.digest(kReqType, sig_payload.encode(), "sha256").hex()
     # request param
     auth_header = (
         f"AWS4-HMAC-SHA256 Credential={aws_key_id}/{NOW_DATE}/{aws_region}/s3/aws4_request,"
         f"SignedHeaders={cheader_names},Signature={signature}"
     )
-    req_headers = cheaders + [
-        ("Content-Length", str(data_len)),
-        ("Authorization", auth_header),
-    ]
+    req_headers = {
+        **cheaders,
+        "Content-Length": str(data_len),
+        "Authorization": auth_header,
+    }
     if session_token:
-        req_headers.append(("X-Amz-Security-Token", session_token))
-    # Make the request
-    conn = http.client.HTTPSConnection(host)
-    conn.request(method, path + f"?{query_str}", body, dict(req_headers))
-    resp = conn.getresponse()
+        req_headers["X-Amz-Security-Token"] = session_token
+    # Make the request (NOTE: read each response fully before reusing its connection)
+    reused = conn is not None
+    conn = conn if reused else http.client.HTTPSConnection(host)
+    try:
+        for can_retry in (reused, False):
+            try:
+                sent = False
+                conn.request(method, path + f"?{query_str}", body, req_headers)
+                sent = True
+                resp = conn.getresponse()
+                break
+            except ConnectionError as e:
+                # reconnect once if the server closed a reused connection while idle, which
+                # means the request either never fully sent or was never responded to
+                stale = not sent or isinstance(e, http.client.RemoteDisconnected)
+                if not (can_retry and stale):
+                    raise
+                conn.close()
+                if hasattr(body, "seek"):
+                    body.seek(0)
+    except Exception:
+        # reset the connection so a failed request doesn't leave it unusable
+        conn.close()
+        raise
+    finally:
+        if body_map is not None:
+            body_map.close()
     return resp
 
 
 class S3FileLikeReadOnly:
     """
     A read-only file-like object that dynamically calls S3 as needed.
+
+    NOTE: Unlike s3_request(), path is the plain key path (e.g. "/my file.txt"), which
+    gets URI-quoted before being sent, so don't pass an already quoted path.
     """
 
     # default methods
@@ -128,6 +256,7 @@ class S3FileLikeReadOnly:
         aws_key_id=None,
         aws_secret=None,
         session_token=None,
+        conn=None,
     ):
         self._aws_config = {
             "bucket": bucket,
@@ -141,20 +270,25 @@ class S3FileLikeReadOnly:
                 "Since this is a read-only file-like object, only modes 'r', 'rb', and 'rt' are allowed."
             )
         self.name = path
+        self._quoted_path = urllib.parse.quote(path, safe="/")
         self.mode = mode
         self.closed = False
         self._encoding = encoding
         self._size = None
         self._tell = 0
+        self._conn = conn
 
     # raise exception when file doesn't exist
     @property
     def size(self):
         if self._size is None:
-            resp = s3_request("HEAD", self.name, **self._aws_config)
+            resp = s3_request(
+                "HEAD", self._quoted_path, conn=self._conn, **self._aws_config
+            )
+            resp_body = resp.read()
             if resp.status != 200:
                 raise OSError(
-                    f"Error retrieving HEAD from S3: {resp.status} {resp.reason}\n{resp.read().decode()}"
+                    f"Error retrieving HEAD from S3: {resp.status} {resp.reason}\n{resp_body.decode()}"
                 )
             self._size = int(resp.headers["Content-Length"])
         return self._size
@@ -176,21 +310,39 @@ class S3FileLikeReadOnly:
     def read(self, n=None):
         if self.closed:
             raise OSError("This S3 file is closed")
-        if self.tell() >= self.size:
-            return "" if "b" not in self.mode else b""
-        range_end = min(self.size if n is None else (self.tell() + n), self.size)
-        headers = {"Range": f"bytes={self.tell()}-{range_end - 1}"}
-        resp = s3_request("GET", self.name, headers=headers, **self._aws_config)
-        if resp.status != 206:
+        # reading the whole file doesn't need a HEAD request to know its size first
+        if n is None and self._size is None and self._tell == 0:
+            headers = None
+            expected_status = 200
+        else:
+            if self.tell() >= self.size:
+                return "" if "b" not in self.mode else b""
+            range_end = min(self.size if n is None else (self.tell() + n), self.size)
+            headers = {"Range": f"bytes={self.tell()}-{range_end - 1}"}
+            expected_status = 206
+        resp = s3_request(
+            "GET",
+            self._quoted_path,
+            headers=headers,
+            conn=self._conn,
+            **self._aws_config,
+        )
+        resp_bytes = resp.read()
+        if resp.status != expected_status:
             raise OSError(
-                f"Error retrieving file from S3: {resp.status} {resp.reason}\n{resp.read().decode()}"
+                f"Error retrieving file from S3: {resp.status} {resp.reason}\n{resp_bytes.decode()}"
             )
-        resp_bytes = resp.read()
+        if headers is None:
+            self._size = int(resp.headers["Content-Length"])
+            range_end = self._size
         self._tell = range_end
         if "b" not in self.mode:
-            return io.TextIOWrapper(
-                io.BytesIO(resp_bytes), encoding=self._encoding
-            ).read()
+            # decode without copying into a buffer, translating newlines like text-mode files
+            encoding = self._encoding or locale.getpreferredencoding(False)
+            decoder = codecs.getincrementaldecoder(encoding)()
+            return io.IncrementalNewlineDecoder(decoder, translate=True).decode(
+                resp_bytes, final=True
+            )
         return resp_bytes
 
     def close(self):
@@ -1,10 +1,24 @@
-from html import escape
+import contextlib
+import http.client
+import re
+import threading
+import urllib.parse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from html import escape, unescape
 from xml.etree.ElementTree import fromstring
 from django.core.files.base import File
 from django.core.files.storage.base import Storage
 from django.conf import settings
 from .barebones_s3 import s3_request, s3_open
 
+# find the next page's token without waiting to parse the whole listing
+_NEXT_TOKEN_RE = re.compile(rb"<NextContinuationToken>(.*?)</NextContinuationToken>")
+
+# S3 XML namespaced paths, so listings can be searched without wildcard lookups
+_S3_NS = "{http://s3.amazonaws.com/doc/2006-03-01/}"
+_KEY_PATH = f"{_S3_NS}Contents/{_S3_NS}Key"
+_PREFIX_PATH = f"{_S3_NS}CommonPrefixes/{_S3_NS}Prefix"
+
 
 class S3Storage(Storage):
     """
@@ -30,6 +44,7 @@ class S3Storage(Storage):
 
     do_multipart_at = 10000000  # 10MB
     multipart_chunk_size = 10000000  # 10MB
+    multipart_workers = 8  # parts uploaded in parallel
 
     def __init__(self, **kwargs):
         self.aws_conf = {
@@ -43,92 +58,200 @@ class S3Storage(Storage):
         self.multipart_chunk_size = kwargs.pop(
             "multipart_chunk_size", self.multipart_chunk_size
         )
+        self.multipart_workers = kwargs.pop("multipart_workers", self.multipart_workers)
+        self._local = threading.local()
+        # the host only needs formatting once, unless the bucket or region are callables
+        bucket, aws_region = self.aws_conf["bucket"], self.aws_conf["aws_region"]
+        self._host = (
+            None
+            if callable(bucket) or callable(aws_region)
+            else f"{bucket}.s3.{aws_region}.amazonaws.com"
+        )
         return super().__init__(**kwargs)
 
+    # reuse a keep-alive connection per thread, since storages are shared by threads
+    def _get_conn(self):
+        host = self._host
+        if host is None:
+            bucket, aws_region = (
+                v() if callable(v) else v
+                for v in (self.aws_conf["bucket"], self.aws_conf["aws_region"])
+            )
+            host = f"{bucket}.s3.{aws_region}.amazonaws.com"
+        conn = getattr(self._local, "conn", None)
+        if conn is None or conn.host != host:
+            if conn is not None:
+                conn.close()
+            conn = self._local.conn = http.client.HTTPSConnection(host)
+        return conn
+
+    # worker threads get their own connections, which are closed along with the pool
+    @contextlib.contextmanager
+    def _worker_pool(self, max_workers):
+        worker_conns = []
+
+        def init_worker():
+            worker_conns.append(self._get_conn())
+
+        try:
+            with ThreadPoolExecutor(max_workers, initializer=init_worker) as executor:
+                yield executor
+        finally:
+            for conn in worker_conns:
+                conn.close()
+
+    # storage names are plain keys, so quote them for the S3 API request path
+    def _request(self, method, path, **kwargs):
+        quoted_path = urllib.parse.quote(path, safe="/")
+        return s3_request(
+            method, quoted_path, conn=self._get_conn, **kwargs, **self.aws_conf
+        )
+
     def _open(self, name, mode="rb"):
-        return File(s3_open(f"/{name}", mode, **self.aws_conf))
+        # the file looks up the connection for whichever thread reads it
+        return File(s3_open(f"/{name}", mode, conn=self._get_conn, **self.aws_conf))
 
     def _save(self, name, content):
         save_name = self.get_available_name(name)
         # single-request upload for smaller files
         if content.size < self.do_multipart_at:
-            resp = s3_request("PUT", f"/{save_name}", body=content, **self.aws_conf)
+            resp = self._request(
+                "PUT",
+                f"/{save_name}",
+                body=content,
+                unsigned_payload=True,
+            )
+            resp.read()
             assert resp.status == 200
         # mulitpart upload for larger files
         else:
-            start_resp = s3_request(
-                "POST", f"/{save_name}", query={"uploads": ""}, **self.aws_conf
+            start_resp = self._request(
+                "POST",
+                f"/{save_name}",
+                query={"uploads": ""},
             )
+            start_resp_body = start_resp.read()
             assert start_resp.status == 200
-            upload_id = fromstring(start_resp.read().decode()).find("{*}UploadId").text
-            cur_part_id = 1
-            part_entries = []
-            while True:
-                part_body = content.read(self.multipart_chunk_size)
-                if not part_body:
-                    break
-                query = {"partNumber": cur_part_id, "uploadId": upload_id}
-                part_resp = s3_request(
-                    "PUT", f"/{save_name}", query=query, body=part_body, **self.aws_conf
+            upload_id = fromstring(start_resp_body.decode()).find("{*}UploadId").text
+            upload_qs = urllib.parse.urlencode({"uploadId": upload_id})
+            part_etags = []
+            with self._worker_pool(self.multipart_workers) as executor:
+                pending = set()
+                cur_part_id = 1
+                while True:
+                    # limit how many parts are held in memory at once
+                    if len(pending) >= self.multipart_workers:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        part_etags += [f.result() for f in done]
+                    part_body = content.read(self.multipart_chunk_size)
+                    if not part_body:
+                        break
+                    pending.add(
+                        executor.submit(
+                            self._upload_part,
+                            save_name,
+                            upload_qs,
+                            cur_part_id,
+                            part_body,
+                        )
+                    )
+                    cur_part_id += 1
+                part_etags += [f.result() for f in pending]
+            part_entries = [
+                b'<?xml version="1.0" encoding="UTF-8"?>\n'
+                b'<CompleteMultipartUpload xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+            ]
+            for part_id, etag in sorted(part_etags):
+                part_entries.extend(
+                    (
+                        b"<Part><ETag>",
+                        etag.encode(),
+                        b"</ETag><PartNumber>",
+                        str(part_id).encode(),
+                        b"</PartNumber></Part>",
+                    )
                 )
-                assert part_resp.status == 200
-                etag = escape(part_resp.headers["ETag"])
-                part_entries.append(
-                    f"<Part><ETag>{etag}</ETag><PartNumber>{cur_part_id}</PartNumber></Part>"
-                )
-                cur_part_id += 1
-            end_resp_payload = f"""<?xml version="1.0" encoding="UTF-8"?>
-                <CompleteMultipartUpload xmlns="http://s3.amazonaws.com/doc/2006-03-01/">
-                {''.join(part_entries)}</CompleteMultipartUpload>""".encode()
-            end_resp = s3_request(
+            part_entries.append(b"</CompleteMultipartUpload>")
+            end_resp_payload = b"".join(part_entries)
+            end_resp = self._request(
                 "POST",
                 f"/{save_name}",
-                query={"uploadId": upload_id},
                 body=end_resp_payload,
-                **self.aws_conf,
+                query_str=upload_qs,
             )
             # successful not when 200, but when there's a Location in the response body
             assert fromstring(end_resp.read().decode()).find("{*}Location") is not None
         return save_name
 
+    def _upload_part(self, save_name, upload_qs, part_id, part_body):
+        part_resp = self._request(
+            "PUT",
+            f"/{save_name}",
+            body=part_body,
+            query_str=f"partNumber={part_id}&{upload_qs}",
+        )
+        part_resp.read()
+        assert part_resp.status == 200
+        return part_id, escape(part_resp.headers["ETag"])
+
     def path(self, name):
         return name
 
     def delete(self, name):
-        resp = s3_request("DELETE", f"/{name}", **self.aws_conf)
+        resp = self._request("DELETE", f"/{name}")
+        resp.read()
         assert resp.status == 204
 
     def exists(self, name):
-        resp = s3_request("HEAD", f"/{name}", **self.aws_conf)
+        resp = self._request("HEAD", f"/{name}")
+        resp.read()
         assert resp.status in [200, 404]
         return resp.status == 200
 
     def listdir(self, path):
         directories, files = [], []
         path += "/" if path and not path.endswith("/") else ""
-        query = {"list-type": "2", "prefix": path, "delimiter": "/"}
-        while True:
-            resp = s3_request("GET", "/", query=query, **self.aws_conf)
-            assert resp.status == 200
-            resp_bytes = resp.read().decode()
-            resp_xml = fromstring(resp_bytes)
-            for key in resp_xml.findall("{*}Contents/{*}Key"):
-                files.append(key.text)
-            for prefix in resp_xml.findall("{*}CommonPrefixes/{*}Prefix"):
-                directories.append(prefix.text)
-            continuationToken = resp_xml.find("{*}NextContinuationToken")
-            if continuationToken is not None:
-                query["continuation-token"] = continuationToken.text
-            else:
-                break
+        # only the continuation token changes between pages (NOTE: it sorts first)
+        base_qs = urllib.parse.urlencode(
+            {"delimiter": "/", "list-type": "2", "prefix": path}
+        )
+        with contextlib.ExitStack() as stack:
+            executor = None
+            # most listings are a single page, so fetch the first one on this thread
+            resp_bytes = self._list_page(base_qs)
+            while resp_bytes is not None:
+                next_page = None
+                next_token = _NEXT_TOKEN_RE.search(resp_bytes)
+                if next_token is not None:
+                    # fetch the next page in the background while parsing this one
+                    if executor is None:
+                        executor = stack.enter_context(self._worker_pool(1))
+                    token = unescape(next_token.group(1).decode())
+                    token_qs = urllib.parse.urlencode({"continuation-token": token})
+                    next_page = executor.submit(
+                        self._list_page, f"{token_qs}&{base_qs}"
+                    )
+                resp_xml = fromstring(resp_bytes)
+                for key in resp_xml.iterfind(_KEY_PATH):
+                    files.append(key.text)
+                for prefix in resp_xml.iterfind(_PREFIX_PATH):
+                    directories.append(prefix.text)
+                resp_bytes = next_page.result() if next_page is not None else None
         if path:
             files = [f.split(path, 1)[1] for f in files]
             directories = [d.split(path, 1)[1] for d in directories]
         directories = [d.rstrip("/") for d in directories]
         return directories, files
 
+    def _list_page(self, query_str):
+        resp = self._request("GET", "/", query_str=query_str)
+        resp_bytes = resp.read()
+        assert resp.status == 200
+        return resp_bytes
+
     def size(self, name):
-        resp = s3_request("HEAD", f"/{name}", **self.aws_conf)
+        resp = self._request("HEAD", f"/{name}")
+        resp.read()
         assert resp.status == 200
         return int(resp.headers["Content-Length"])
 